@@ -20,16 +20,27 @@
 # along with this program; if not, write to the Free Software Foundation,
 # Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
 
-import json
+import fastnumbers
 import logging
+import math
 import paho.mqtt.client as mqtt
+import queue
 import re
-import requests.exceptions
+import signal
 import sys
+import threading
+import time
 import yaml
+from collections import OrderedDict
 from influxdb import InfluxDBClient
 
-cache = {}
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+# maximum number of topics remembered for classification and deduplication
+CACHE_MAX = 4096
 
 
 class MessageStore(object):
@@ -37,28 +48,125 @@ class MessageStore(object):
     def store_msg(self, tags, measurement_name, value):
         raise NotImplementedError()
 
+    def close(self):
+        pass
+
+
+def escape_measurement(name):
+    # same escaping as influxdb-python applies to measurement names
+    return escape_key(name)
+
+
+def escape_key(key):
+    # escaping of tag keys, tag values and field keys
+    return key.replace('\\', '\\\\').replace(' ', '\\ ').replace(',', '\\,').replace('=', '\\=').replace('\n', '\\n')
+
+
+def format_field_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return '%di' % value
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    elif not isinstance(value, str):
+        value = str(value)
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
 
 class InfluxStore(MessageStore):
     logger = logging.getLogger("forwarder.InfluxStore")
 
-    def __init__(self, host, port, username, password, database):
+    def __init__(self, host, port, username, password, database, batch_size=100, batch_timeout=1.0, gzip=True,
+                 create_database=False, max_pending=None, timeout=10):
+        # the client keeps its HTTP connections alive in a requests session,
+        # gzip compresses the body of each batch
         self.influx_client = InfluxDBClient(
-            host=host, port=port, username=username, password=password, database=database)
-        self.influx_client.create_database(database)
+            host=host, port=port, username=username, password=password, database=database,
+            gzip=gzip, pool_size=10, timeout=timeout)
+        if create_database:
+            self.influx_client.create_database(database)
+        self._database = database
+        # points are buffered as line protocol and written in batches by a
+        # single writer thread, either when batch_size points are pending or
+        # every batch_timeout seconds. At most max_pending points are
+        # buffered, store_msg waits for the writer beyond that.
+        self._buffer = bytearray()
+        self._pending = 0
+        self._batch_ready = threading.Condition()
+        self._max_batch = batch_size
+        self._max_pending = max_pending or 10 * batch_size
+        self._max_age = batch_timeout
+        self._closing = False
+        self._writer = threading.Thread(target=self._write_batches, name="InfluxStore-writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _format_point(self, measurement_name, tags, data):
+        # InfluxDB has no representation for null, NaN or infinite values
+        fields = ','.join(escape_key(key) + '=' + format_field_value(value) for key, value in data.items()
+                          if value is not None and not (isinstance(value, float) and not math.isfinite(value)))
+        if not fields:
+            return None
+        line = escape_measurement(measurement_name)
+        # tags sorted by key, as recommended by InfluxDB
+        for key in sorted(tags):
+            value = tags[key]
+            if value:
+                line += ',' + escape_key(key) + '=' + escape_key(value)
+        # points are written later on, so they must be timestamped now
+        line += ' %s %d\n' % (fields, int(time.time() * 1000000))
+        return line.encode('utf-8')
 
     def store_msg(self, tags, measurement_name, data):
         if not isinstance(data, dict):
             raise ValueError('data must be given as dict!')
-        influx_msg = {
-            'measurement': measurement_name,
-            'tags': tags,
-            'fields': data
-        }
-        self.logger.debug("Writing InfluxDB point: %s", influx_msg)
-        try:
-            self.influx_client.write_points([influx_msg])
-        except requests.exceptions.ConnectionError as e:
-            self.logger.exception(e)
+        point = self._format_point(measurement_name, tags, data)
+        if point is None:
+            self.logger.warn("No field to write for measurement %s, skipping", measurement_name)
+            return
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("Buffering InfluxDB point: %s", point.decode('utf-8').rstrip())
+        with self._batch_ready:
+            # back-pressure: the forwarding queue in front of the store then
+            # fills up and drops the oldest messages
+            self._batch_ready.wait_for(lambda: self._pending < self._max_pending)
+            self._buffer += point
+            self._pending += 1
+            if self._pending >= self._max_batch:
+                self._batch_ready.notify_all()
+
+    def _write_batches(self):
+        while True:
+            with self._batch_ready:
+                self._batch_ready.wait_for(lambda: self._pending >= self._max_batch or self._closing,
+                                           timeout=self._max_age)
+                if not self._pending:
+                    if self._closing:
+                        return
+                    continue
+                # swap buffers, so that points keep being stored while writing
+                data, self._buffer = self._buffer, bytearray()
+                count = self._pending
+                self._pending = 0
+                self._batch_ready.notify_all()
+            self.logger.debug("Writing %d InfluxDB points", count)
+            try:
+                self.influx_client.request(url='write', method='POST',
+                                           params={'db': self._database, 'precision': 'u'}, data=data,
+                                           expected_response_code=204,
+                                           headers={'Content-Type': 'application/octet-stream'})
+            except Exception as e:
+                self.logger.exception(e)
+
+    def close(self):
+        # write the points still buffered, then stop the writer thread
+        with self._batch_ready:
+            self._closing = True
+            self._batch_ready.notify_all()
+        self._writer.join()
 
 
 class MessageSource(object):
@@ -74,25 +182,96 @@ class MessageSource(object):
         return list(self._stores)
 
 
-def build_dict(seq, key):
-    return dict((d[key], dict(d, index=index)) for (index, d) in enumerate(seq))
+def intern_or_none(s):
+    return None if s is None else sys.intern(s)
+
 
+def to_float(value):
+    # values which are not numeric, including JSON null, lists and objects, are kept as is
+    if isinstance(value, (str, bytes, int, float)):
+        return fastnumbers.fast_float(value, default=value)
+    return value
 
-def without_keys(d, keys):
-    return {k: v for k, v in d.items() if k not in keys}
+
+# returned by the declared field converters for values they cannot convert
+INVALID = object()
+
+
+def parse_float(value):
+    if isinstance(value, (str, bytes, int, float)):
+        number = fastnumbers.fast_float(value, default=None)
+        if number is not None:
+            return number
+    return INVALID
+
+
+def parse_int(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (str, bytes, int, float)):
+        number = fastnumbers.fast_real(value, default=None)
+        # a float is only accepted when it is integral, e.g. 3.0, so no data is cut off
+        if isinstance(number, float) and number.is_integer():
+            number = int(number)
+        # InfluxDB integers are signed 64 bits
+        if isinstance(number, int) and -2 ** 63 <= number < 2 ** 63:
+            return number
+    return INVALID
+
+
+FIELD_CONVERTERS = {'float': parse_float, 'int': parse_int, 'str': str}
+
+
+def coerce_all(data):
+    return {k: to_float(v) for k, v in data.items()}
+
+
+def compile_coercer(spec, logger):
+    # the declared fields get their own conversion, all others the generic float conversion
+    try:
+        converters = {key: (type_name, FIELD_CONVERTERS[type_name]) for key, type_name in spec.items()}
+    except KeyError as e:
+        raise ValueError('unknown field type %s, expected one of %s' % (e, ', '.join(FIELD_CONVERTERS)))
+
+    def coerce(data):
+        coerced = {}
+        for key, value in data.items():
+            declared = converters.get(key)
+            if declared is None:
+                coerced[key] = to_float(value)
+                continue
+            if value is None:
+                continue
+            type_name, convert = declared
+            converted = convert(value)
+            if converted is INVALID:
+                # writing it anyway would make InfluxDB reject the point for a field type conflict
+                logger.warn("Could not convert field %s value %r to %s, skipping field", key, value, type_name)
+            else:
+                coerced[key] = converted
+        return coerced
+    return coerce
 
 
 class MQTTSource(MessageSource):
     logger = logging.getLogger("forwarder.MQTTSource")
 
-    def __init__(self, host, port, user, password, nodes, stringify_values_for_measurements):
+    def __init__(self, host, port, user, password, nodes, stringify_values_for_measurements, queue_size=10000):
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.nodes = nodes
-        self.stringify = stringify_values_for_measurements
-        self.node_by_name = build_dict(nodes, key="name")
+        self.stringify = frozenset(stringify_values_for_measurements or ())
+        self.node_by_name = {node['name']: node for node in nodes}
+        # last payload received per topic, least recently updated first
+        self._cache = OrderedDict()
+        # measurement name, tags and field coercion of already classified topics, oldest first
+        self._topics = OrderedDict()
+        # decoded messages waiting to be handed over to the stores
+        self._out_queue = queue.Queue(maxsize=queue_size)
+        self._forwarder = threading.Thread(target=self._forward, name="MQTTSource-forwarder")
+        self._forwarder.daemon = True
         self._setup_handlers()
 
     def _setup_handlers(self):
@@ -100,6 +279,14 @@ class MQTTSource(MessageSource):
         if self.user is not None and self.password is not None:
             self.client.username_pw_set(self.user, self.password)
 
+        # compile topic regexes once instead of on every message
+        token_pattern = '(?:\w|-|\.)+'
+        for node in self.node_by_name.values():
+            node['compiled'] = re.compile(node['regex'].replace('token_pattern', token_pattern))
+            # every named group but the measurement name becomes a tag
+            node['tag_keys'] = frozenset(sys.intern(k) for k in node['compiled'].groupindex) - {'measurement_name'}
+            node['coerce'] = compile_coercer(node['fields'], self.logger) if node.get('fields') else coerce_all
+
         def on_connect(client, userdata, flags, rc):
             self.logger.info("Connected with result code  %s", rc)
             # subscribe to /node_name/wildcard
@@ -110,86 +297,147 @@ class MQTTSource(MessageSource):
                 client.subscribe(topic)
 
         def on_message(client, userdata, msg):
-            self.logger.debug(
-                "Received MQTT message for topic %s with payload %s", msg.topic, msg.payload)
-            token_pattern = '(?:\w|-|\.)+'
-
-            regex = re.compile('(?P<node_name>' + token_pattern + ')/?')
-            match = regex.match(msg.topic)
-            if match is None:
-                self.logger.warn(
-                    "Could not extract node name from topic %s", msg.topic)
+            # checked once, so that debug arguments are not evaluated on every message
+            debug = self.logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                self.logger.debug(
+                    "Received MQTT message for topic %s with payload %s", msg.topic, msg.payload)
+            classified = self._classify_topic(msg.topic)
+            if classified is None:
                 return
+            measurement_name, tags, coerce = classified
 
-            node_name = match.group('node_name')
-            node = self.node_by_name.get(node_name, None)
-
-            if node is None:
-                self.logger.warn(
-                    "Extract node_name %s from topic, but requested to receive messages for nodes %s", node_name,
-                    self.nodes)
-                return
+            # payload is kept as bytes, it is only decoded when stored as a string
+            value = msg.payload
 
-            regex = re.compile(node['regex'].replace('token_pattern', token_pattern))
-            match = regex.match(msg.topic)
-            if match is None:
-                self.logger.warn(
-                    "Could not extract measurement name from topic %s", msg.topic)
+            # skip unchanged values before doing any decoding work
+            if debug:
+                self.logger.debug("cache : %s", self._cache)
+            if self._cache.get(msg.topic) == value:
+                self.logger.info("value did not changed for : %s, skipping", measurement_name)
                 return
-
-            measurement_name = match.group('measurement_name')
-
-            value = msg.payload
+            self._cache[msg.topic] = value
+            self._cache.move_to_end(msg.topic)
+            if len(self._cache) > CACHE_MAX:
+                self._cache.popitem(last=False)
 
             is_value_json_dict = False
-            try:
-                stored_message = json.loads(value)
-                is_value_json_dict = isinstance(stored_message, dict)
-            except ValueError:
-                pass
+            # only a payload starting with '{' can decode to a JSON dict
+            if value.lstrip()[:1] == b'{':
+                try:
+                    stored_message = json.loads(value)
+                    is_value_json_dict = isinstance(stored_message, dict)
+                except ValueError:
+                    pass
 
             if is_value_json_dict:
-                for key in stored_message.keys():
-                    try:
-                        stored_message[key] = float(stored_message[key])
-                    except ValueError:
-                        pass
+                stored_message = coerce(stored_message)
             else:
                 # if message is not a JSON DICT, only then check if we should stringify the value
-                self.logger.debug(self.stringify)
                 if measurement_name in self.stringify:
-                    value = str(value)
+                    value = value.decode('utf-8', 'replace')
                 else:
-                    try:
-                        value = float(value)
-                    except ValueError:
-                        pass
-                self.logger.debug(value)
+                    value = fastnumbers.fast_float(value, default=value)
                 stored_message = {'value': value}
 
-            global cache
-            self.logger.debug("measurement_name : %s | data : %s", measurement_name, value)
-            self.logger.debug("cache : %s", cache)
-            if measurement_name in cache and cache[measurement_name] == value:
-                self.logger.info("value did not changed for : %s, skipping", measurement_name)
-            else:
-                cache[measurement_name] = value
-
-
-            self.logger.debug("Going to store")
-            for store in self.stores:
-                store.store_msg(without_keys(match.groupdict(), 'measurement_name'), measurement_name, stored_message)
+            if debug:
+                self.logger.debug("measurement_name : %s | data : %s", measurement_name, value)
+                self.logger.debug("Going to store")
+            self._enqueue((tags, measurement_name, stored_message))
 
         self.client.on_connect = on_connect
         self.client.on_message = on_message
 
+    def _classify_topic(self, topic):
+        # returns the measurement name, tags and field coercion of a topic, or None when the
+        # topic does not belong to a configured node
+        classified = self._topics.get(topic)
+        if classified is not None:
+            return classified
+
+        # node name is everything before the first '/'
+        node_name, _, _ = topic.partition('/')
+        if not node_name:
+            self.logger.warn(
+                "Could not extract node name from topic %s", topic)
+            return None
+
+        node = self.node_by_name.get(node_name)
+
+        if node is None:
+            self.logger.warn(
+                "Extract node_name %s from topic, but requested to receive messages for nodes %s", node_name,
+                list(self.node_by_name))
+            return None
+
+        match = node['compiled'].match(topic)
+        if match is None:
+            self.logger.warn(
+                "Could not extract measurement name from topic %s", topic)
+            return None
+
+        # names and tag values are shared by many topics (e.g. the same
+        # measurement in every room) and kept for the life of the process
+        tags = {k: intern_or_none(match.group(k)) for k in node['tag_keys']}
+        classified = sys.intern(match.group('measurement_name')), tags, node['coerce']
+        self._topics[topic] = classified
+        if len(self._topics) > CACHE_MAX:
+            self._topics.popitem(last=False)
+        return classified
+
+    def _enqueue(self, item):
+        # never block paho's network thread: when the stores cannot keep up,
+        # drop the oldest pending message
+        while True:
+            try:
+                self._out_queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self._out_queue.get_nowait()
+                    self.logger.warn("Forwarding queue is full, dropping oldest message")
+                except queue.Empty:
+                    pass
+
+    def _forward(self):
+        while True:
+            item = self._out_queue.get()
+            if item is None:
+                # stop() was called and the queue is drained
+                return
+            tags, measurement_name, stored_message = item
+            for store in self.stores:
+                try:
+                    store.store_msg(tags, measurement_name, stored_message)
+                except Exception as e:
+                    self.logger.exception(e)
+
     def start(self):
+        self._forwarder.start()
         self.client.connect(self.host, self.port)
-        # Blocking call that processes network traffic, dispatches callbacks and
-        # handles reconnecting.
-        # Other loop*() functions are available that give a threaded interface and a
-        # manual interface.
-        self.client.loop_forever()
+        # Process network traffic, dispatch callbacks and handle reconnecting
+        # in paho's background thread, so that writing to the stores on the
+        # forwarder thread never stalls MQTT reception.
+        self.client.loop_start()
+        # block until Ctrl-C or SIGTERM (e.g. docker stop)
+        stopped = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+        try:
+            stopped.wait()
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def stop(self):
+        self.logger.info("Stopping, writing pending messages")
+        self.client.disconnect()
+        # once paho's thread is stopped, on_message is no longer called and
+        # the end of queue marker is the last item
+        self.client.loop_stop()
+        self._out_queue.put(None)
+        self._forwarder.join()
+        for store in self.stores:
+            store.close()
 
 
 def main():
@@ -212,13 +460,20 @@ def main():
                         port=config['influx'].get('port', 8086),
                         username=config['influx']['user'],
                         password=config['influx']['password'],
-                        database=config['influx']['database'])
+                        database=config['influx']['database'],
+                        batch_size=config['influx'].get('batch_size', 100),
+                        batch_timeout=config['influx'].get('batch_timeout', 1.0),
+                        gzip=config['influx'].get('gzip', True),
+                        create_database=config['influx'].get('create_database', False),
+                        max_pending=config['influx'].get('max_pending'),
+                        timeout=config['influx'].get('timeout', 10))
     source = MQTTSource(host=config['mqtt']['host'],
                         port=config['mqtt'].get('port', 1883),
                         user=config['mqtt']['user'],
                         password=config['mqtt']['password'],
                         nodes=config['nodes'],
-                        stringify_values_for_measurements=config.get('stringify_values_for_measurements', []))
+                        stringify_values_for_measurements=config.get('stringify_values_for_measurements', []),
+                        queue_size=config['mqtt'].get('queue_size', 10000))
     source.register_store(store)
     source.start()
 